@@ -0,0 +1,33 @@
+import io
+import base64
+from PIL import Image
+
+# Kept free of import-time side effects: encoder processes import this module (and, under the spawn
+# start method, main.py as well), so it must not open files, start threads or touch the Flask app
+
+# Images are shrunk to fit this size before sending; the vision model downsamples further anyway
+MAX_IMAGE_SIZE = (1024, 1024)
+JPEG_QUALITY = 85
+
+def downscale_image(image_data):
+    """Return the image as a JPEG no larger than MAX_IMAGE_SIZE, or unchanged if it already is one"""
+    with Image.open(io.BytesIO(image_data)) as img:
+        if img.format == 'JPEG' and img.width <= MAX_IMAGE_SIZE[0] and img.height <= MAX_IMAGE_SIZE[1]:
+            return image_data
+        # Lets the JPEG decoder scale down while decoding instead of loading every pixel
+        img.draft('RGB', MAX_IMAGE_SIZE)
+        img.thumbnail(MAX_IMAGE_SIZE, Image.LANCZOS)
+        buf = io.BytesIO()
+        img.convert('RGB').save(buf, 'JPEG', quality=JPEG_QUALITY)
+        return buf.getvalue()
+
+def encode_image(image_path):
+    """Downscale and base64-encode an image; runs in the encoder process pool"""
+    with open(image_path, 'rb') as f:
+        image_data = f.read()
+    try:
+        image_data = downscale_image(image_data)
+    except Image.DecompressionBombError:
+        # Too many pixels for Pillow to decode safely; send the original file as it was before downscaling
+        pass
+    return base64.b64encode(image_data).decode('ascii')
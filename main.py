@@ -1,37 +1,146 @@
 import os
+import re
 import time
+import asyncio
 import json
+import atexit
+import hashlib
+import queue
 import logging
+import multiprocessing
+import sqlite3
+import threading
 import traceback
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify
-from PIL import Image, UnidentifiedImageError
+from logging.handlers import QueueHandler, QueueListener
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, send_file, jsonify
+from PIL import UnidentifiedImageError
+import httpx
 import ollama
+from image_encoding import encode_image
 
 # Initialize Flask app
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'
 
-# Configure logging
-logging.basicConfig(
-    filename=os.path.join(os.path.dirname(__file__), 'processing.log'),
-    filemode='a',
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-
 # Define file paths relative to the script's directory
 SCRIPT_DIR = os.path.dirname(__file__)
-CHECKPOINT_FILE = os.path.join(SCRIPT_DIR, 'processed_images.json')
+CHECKPOINT_FILE = os.path.join(SCRIPT_DIR, 'processed_images.log')
 OUTPUT_FILE = os.path.join(SCRIPT_DIR, 'Output_Descriptions.txt')
+CACHE_FILE = os.path.join(SCRIPT_DIR, 'descriptions.db')
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff', '.webp')
+
+# Ollama connection settings
+OLLAMA_HOST = os.environ.get('OLLAMA_HOST', 'http://127.0.0.1:11434')
+MODEL = "llama3.2-vision:11b"
+KEEP_ALIVE = "30m"
+
+# Maximum number of chat requests in flight at once: as many as the server runs in parallel
+# (OLLAMA_NUM_PARALLEL, 1 unless configured) plus one queued so it never sits idle between requests
+MAX_INFLIGHT = int(os.environ.get('OLLAMA_NUM_PARALLEL') or 1) + 1
+
+# Threads reading images ahead of the requests that send them, and processes downscaling them;
+# decoding holds the GIL, so it gets its own pool instead of stalling the readers
+READER_THREADS = 2
+ENCODER_PROCESSES = os.cpu_count() or 1
+
+# Upper bound on images sent to the model in a single chat request
+BATCH_SIZE = 4
+
+# Model families Ollama only accepts one image per message for; batching is off from the start for
+# these, and for any other model as soon as the server rejects a multi-image request
+SINGLE_IMAGE_MODELS = ('llama3.2-vision',)
+_batching_supported = not MODEL.startswith(SINGLE_IMAGE_MODELS)
+
+# Matches the "1." / "Image 1:" / "**2)**" / "**Image 1**" markers the model puts in front of each description
+NUMBERED_ITEM = re.compile(r'^\W*(?:image\s*)?(\d+)(?:\s*[.):\-]+|\**[ \t]*$)\W*', re.IGNORECASE | re.MULTILINE)
+
+# Generation is cut off once a description reaches the sentence limit the prompt asks for, e.g.
+# "no more than 5 sentences"; prompts without one are left to finish on their own
+SENTENCE_LIMIT = re.compile(
+    r'\b(?:no more than|not more than|at most|up to|(?:a )?maximum of|max(?:imum)?|in)\s+'
+    r'(\d+|one|two|three|four|five|six|seven|eight|nine|ten)\s+sentences?\b',
+    re.IGNORECASE
+)
+NUMBER_WORDS = {'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10}
+# A terminator only counts once whitespace has followed it, so a streamed "3" + "." + "5" isn't a
+# sentence end; the word before it is captured to skip abbreviations like "e.g." and "Mr."
+SENTENCE_END = re.compile(r'(\w+(?:\.\w+)*)?([.!?]+)(?=\s)')
+ABBREVIATIONS = {'e.g', 'i.e', 'mr', 'mrs', 'ms', 'dr', 'st', 'vs', 'approx', 'jr', 'sr', 'no', 'fig'}
+
+# File signatures of the supported image formats, checked instead of a full decode
+IMAGE_SIGNATURES = (
+    b'\x89PNG',
+    b'\xff\xd8\xff',
+    b'GIF8',
+    b'BM',
+    b'II*\x00',
+    b'MM\x00*',
+)
 
 # Global variables for progress and timer
 progress = {
     'total_images': 0,
     'processed_images': 0,
-    'start_time': None
+    'start_time': None,
+    'running': False
 }
 
+# How often /events checks for new progress, and how long it stays silent before a keep-alive
+EVENT_INTERVAL = 0.25
+EVENT_KEEPALIVE = 15
+
+# Logging and the cache are set up on first use rather than at import, because encoder processes
+# started with spawn re-import this module and must not open the log, the database or threads
+_setup_lock = threading.Lock()
+_log_listener = None
+
+def configure_logging():
+    """Queue log records and write them to the log file from a listener thread"""
+    global _log_listener
+    with _setup_lock:
+        if _log_listener is not None:
+            return
+        log_queue = queue.Queue(-1)
+        file_handler = logging.FileHandler(os.path.join(SCRIPT_DIR, 'processing.log'), mode='a')
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        _log_listener = QueueListener(log_queue, file_handler)
+        _log_listener.start()
+        atexit.register(_log_listener.stop)
+        logging.getLogger().addHandler(QueueHandler(log_queue))
+        logging.getLogger().setLevel(logging.INFO)
+
+# Descriptions keyed by a hash of the prompt and image bytes, kept across runs
+_cache_lock = threading.Lock()
+_cache = None
+
+def cache_connection():
+    """Open the cache on first use; callers hold _cache_lock"""
+    global _cache
+    if _cache is None:
+        _cache = sqlite3.connect(CACHE_FILE, check_same_thread=False)
+        _cache.execute('CREATE TABLE IF NOT EXISTS descriptions (key TEXT PRIMARY KEY, description TEXT NOT NULL)')
+        _cache.commit()
+    return _cache
+
+def description_key(image_data, prompt):
+    return hashlib.blake2b(prompt.encode('utf-8') + image_data, digest_size=16).hexdigest()
+
+def get_cached_description(key):
+    with _cache_lock:
+        row = cache_connection().execute('SELECT description FROM descriptions WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else None
+
+def cache_descriptions(entries):
+    """Store (key, description) pairs in one transaction"""
+    with _cache_lock:
+        cache = cache_connection()
+        cache.executemany('INSERT OR REPLACE INTO descriptions (key, description) VALUES (?, ?)', entries)
+        cache.commit()
+
 def cleanup_files():
     """Delete temporary files after processing is complete"""
     try:
@@ -43,105 +152,420 @@ def cleanup_files():
         logging.error(f"Error during cleanup: {str(e)}")
 
 def load_checkpoint():
-    if os.path.exists(CHECKPOINT_FILE):
-        with open(CHECKPOINT_FILE, 'r', encoding='utf-8') as f:
-            return set(json.load(f))
-    return set()
+    if not os.path.exists(CHECKPOINT_FILE):
+        return set()
+    # One bulk read and a C-level split instead of iterating the log line by line
+    with open(CHECKPOINT_FILE, 'r', encoding='utf-8') as f:
+        names = f.read().splitlines()
+    processed = set(names)
+    processed.discard('')
+    # Compact the log once it is mostly repeated entries
+    if len(names) > 2 * len(processed):
+        # Written aside and swapped in, so a crash mid-write leaves the old log intact
+        compacted = CHECKPOINT_FILE + '.tmp'
+        with open(compacted, 'w', encoding='utf-8') as f:
+            f.writelines(name + '\n' for name in processed)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(compacted, CHECKPOINT_FILE)
+    return processed
+
+def open_checkpoint():
+    # Line buffered so every processed image is on disk as soon as it is recorded
+    return open(CHECKPOINT_FILE, 'a', encoding='utf-8', buffering=1)
+
+def append_checkpoint(checkpoint, image):
+    checkpoint.write(image + '\n')
+
+# Output lines are queued and written by a single thread that keeps the file open; each run has
+# its own queue so concurrent runs can't consume each other's sentinel. Images are checkpointed by
+# the same thread, only after their description has been flushed, so a crash can't record an image
+# as processed while its description is still sitting in the buffer
+_WRITE_DONE = object()
+
+def _output_writer(output, checkpoint):
+    written = []
+    with open(OUTPUT_FILE, 'a', encoding='utf-8', buffering=1 << 20) as outfile:
+        while (item := output.get()) is not _WRITE_DONE:
+            line, image = item
+            outfile.write(line + "\n")
+            if image is not None:
+                written.append(image)
+            if output.empty():
+                outfile.flush()
+                for image in written:
+                    append_checkpoint(checkpoint, image)
+                written.clear()
+        outfile.flush()
+        for image in written:
+            append_checkpoint(checkpoint, image)
+
+def start_output_writer(checkpoint):
+    output = queue.Queue()
+    writer = threading.Thread(target=_output_writer, args=(output, checkpoint), name='output-writer', daemon=True)
+    writer.start()
+    return output, writer
+
+def stop_output_writer(output, writer):
+    output.put(_WRITE_DONE)
+    writer.join()
 
-def save_checkpoint(processed_set):
-    with open(CHECKPOINT_FILE, 'w', encoding='utf-8') as f:
-        json.dump(list(processed_set), f)
+def write_output(output, line, image=None):
+    """Queue a line for the output file; image, if given, is checkpointed once the line is flushed"""
+    output.put((line, image))
 
-def write_output(line):
-    with open(OUTPUT_FILE, 'a', encoding='utf-8') as outfile:
-        outfile.write(line + "\n")
+def check_image_header(image_path, head):
+    """Reject files that don't start with a known image signature without decoding them"""
+    # WebP is a RIFF container, so the format tag at offset 8 tells it apart from WAV or AVI files
+    is_webp = head[:4] == b'RIFF' and head[8:12] == b'WEBP'
+    if not (head.startswith(IMAGE_SIGNATURES) or is_webp):
+        raise UnidentifiedImageError(f"cannot identify image file {image_path!r}")
 
-def process_single_image(image_path, prompt, max_retries=3, timeout=30):
+def read_batch(image_paths, prompt):
+    """
+    Read a chunk of images ahead of sending them. Returns the results already known (unreadable
+    files and cache hits) and (index, cache key, path) for the images the model must describe.
+    """
+    results = [None] * len(image_paths)
+    pending = []
+    for i, image_path in enumerate(image_paths):
+        try:
+            with open(image_path, 'rb') as f:
+                check_image_header(image_path, f.read(12))
+                f.seek(0)
+                image_data = f.read()
+        except (IOError, UnidentifiedImageError) as e:
+            logging.error(f"IOError processing image {image_path}: {str(e)}")
+            results[i] = {"status": "error", "message": f"IOError: {str(e)}"}
+            continue
+        key = description_key(image_data, prompt)
+        cached = get_cached_description(key)
+        if cached is not None:
+            results[i] = {"status": "success", "description": cached}
+        else:
+            pending.append((i, key, image_path))
+    return results, pending
+
+def ollama_client():
+    return httpx.AsyncClient(
+        base_url=OLLAMA_HOST,
+        # No read timeout: a request queued behind others gets no bytes until the server reaches it
+        timeout=httpx.Timeout(connect=10, read=None, write=60, pool=None),
+        limits=httpx.Limits(
+            max_connections=MAX_INFLIGHT,
+            max_keepalive_connections=MAX_INFLIGHT,
+            keepalive_expiry=300
+        )
+    )
+
+def error_text(e):
+    # Some exceptions (httpx timeouts among them) have an empty message
+    return str(e) or type(e).__name__
+
+def count_sentences(text):
+    return sum(
+        1 for word, end in SENTENCE_END.findall(text)
+        if not (end == '.' and word.lower() in ABBREVIATIONS)
+    )
+
+def sentence_limit(prompt):
+    """The maximum number of sentences the prompt asks for, or None if it doesn't set one"""
+    match = SENTENCE_LIMIT.search(prompt)
+    if match is None:
+        return None
+    count = match.group(1).lower()
+    return int(count) if count.isdigit() else NUMBER_WORDS[count]
+
+# Event loop, HTTP client and pools shared by every run, started on first use so connections,
+# threads and worker processes stay warm between folder submissions
+_runtime_lock = threading.Lock()
+_loop = None
+_client = None
+_readers = None
+_encoders = None
+
+def new_encoder_pool():
+    # Spawned rather than forked, so workers don't inherit the loop, reader and writer threads
+    return ProcessPoolExecutor(max_workers=ENCODER_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+
+def replace_encoders(broken):
+    """Swap in a fresh encoder pool after a worker died; concurrent callers only replace it once"""
+    global _encoders
+    with _runtime_lock:
+        if _encoders is broken:
+            logging.warning("Encoder process pool broke, starting a new one")
+            broken.shutdown(wait=False, cancel_futures=True)
+            _encoders = new_encoder_pool()
+
+def start_runtime():
+    global _loop, _client, _readers, _encoders
+    with _runtime_lock:
+        if _loop is None:
+            _readers = ThreadPoolExecutor(max_workers=READER_THREADS, thread_name_prefix='image-reader')
+            _encoders = new_encoder_pool()
+            _client = ollama_client()
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='ollama-loop', daemon=True).start()
+    return _loop
+
+async def chat(client, prompt, images, finished=None):
+    """
+    Stream a chat response. If given, finished is called with the text so far whenever a sentence
+    ends, and the request is abandoned as soon as it returns True, which stops generation on the server.
+    """
+    parts = []
+    async with client.stream('POST', '/api/chat', json={
+        'model': MODEL,
+        'messages': [
+            {
+                'role': 'user',
+                'content': prompt,
+                'images': images
+            }
+        ],
+        'stream': True,
+        'keep_alive': KEEP_ALIVE
+    }) as response:
+        if response.is_error:
+            await response.aread()
+            raise ollama.ResponseError(response.text, response.status_code)
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            part = json.loads(line)
+            if 'error' in part:
+                raise ollama.ResponseError(part['error'])
+            content = part['message']['content']
+            parts.append(content)
+            if part.get('done'):
+                break
+            if finished is not None and any(c in content for c in '.!?\n ') and finished(''.join(parts)):
+                break
+    return ''.join(parts)
+
+async def process_single_image(client, image_path, image, prompt, limit, max_retries=3):
     retries = 0
     while retries < max_retries:
         try:
-            with Image.open(image_path) as img:
-                img.verify()
-            description = get_description(image_path, prompt, timeout)
+            description = await get_description(client, image, prompt, limit)
             return {"status": "success", "description": description}
-        except (IOError, UnidentifiedImageError) as e:
-            logging.error(f"IOError processing image {image_path}: {str(e)}")
-            return {"status": "error", "message": f"IOError: {str(e)}"}
         except ollama.ResponseError as e:
             logging.error(f"Ollama ResponseError for image {image_path}: {str(e)}")
             return {"status": "error", "message": f"Ollama ResponseError: {str(e)}"}
         except Exception as e:
-            logging.error(f"Unexpected error for image {image_path}: {str(e)}\n{traceback.format_exc()}")
+            logging.error(f"Unexpected error for image {image_path}: {error_text(e)}\n{traceback.format_exc()}")
             retries += 1
             if retries < max_retries:
-                time.sleep(2)
+                await asyncio.sleep(2)
             else:
-                return {"status": "error", "message": f"Unexpected error: {str(e)}"}
+                return {"status": "error", "message": f"Unexpected error: {error_text(e)}"}
 
-def get_description(image_path, prompt, timeout=30):
-    res = ollama.chat(
-        model="llama3.2-vision:11b",
-        messages=[
-            {
-                'role': 'user',
-                'content': prompt,
-                'images': [image_path]
-            }
-        ]
+async def get_description(client, image, prompt, limit):
+    finished = None if limit is None else lambda text: count_sentences(text) >= limit
+    return (await chat(client, prompt, [image], finished)).strip()
+
+async def get_descriptions(client, images, prompt, limit):
+    """Describe several images with one chat request, returning one description per image"""
+    if len(images) == 1:
+        return [await get_description(client, images[0], prompt, limit)]
+    batched_prompt = (
+        f"Describe each of the following {len(images)} images separately, "
+        f"numbered 1 to {len(images)}, in the order they were given. "
+        f"For each image: {prompt}"
     )
-    return res['message']['content']
 
-def process_images(folder_path, prompt):
-    global progress
-    images = [file for file in os.listdir(folder_path) if file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff'))]
-    total_images = len(images)
-    processed_images = load_checkpoint()
-    images_to_process = [img for img in images if img not in processed_images]
-    remaining = len(images_to_process)
+    def finished(text):
+        # Only the last image can still be in progress once every number has appeared; it is counted
+        # unstripped so whitespace after its latest terminator is still seen
+        if parse_numbered_descriptions(text, len(images)) is None:
+            return False
+        last = list(NUMBERED_ITEM.finditer(text))[-1]
+        return count_sentences(text[last.end():]) >= limit
 
-    if remaining == 0:
-        flash("All images have already been processed.", "info")
-        return
+    text = await chat(client, batched_prompt, images, None if limit is None else finished)
+    return parse_numbered_descriptions(text, len(images))
 
-    progress['total_images'] = total_images
-    progress['processed_images'] = 0
-    progress['start_time'] = time.time()
+def parse_numbered_descriptions(text, expected):
+    """Split a numbered batch response into its items; returns None if the numbering doesn't line up"""
+    markers = list(NUMBERED_ITEM.finditer(text))
+    if [int(m.group(1)) for m in markers] != list(range(1, expected + 1)):
+        return None
+    descriptions = []
+    for i, marker in enumerate(markers):
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(text)
+        descriptions.append(text[marker.end():end].strip())
+    return descriptions
+
+async def process_batch(client, image_paths, prompt, results, pending):
+    """Describe the pending images of a chunk in one request, falling back to one request per image on failure"""
+    global _batching_supported
+    if not pending:
+        return results
+
+    limit = sentence_limit(prompt)
+    descriptions = None
+    if _batching_supported and len(pending) > 1:
+        try:
+            descriptions = await get_descriptions(client, [image for _, _, image in pending], prompt, limit)
+        except ollama.ResponseError as e:
+            if 'one image' not in str(e):
+                logging.error(f"Batch request failed for {len(pending)} images, retrying individually: {str(e)}")
+            else:
+                logging.info(f"{MODEL} accepts one image per request, batching disabled: {str(e)}")
+                _batching_supported = False
+        except Exception as e:
+            logging.error(f"Batch request failed for {len(pending)} images, retrying individually: {error_text(e)}")
+    if descriptions and not all(descriptions):
+        descriptions = None
+    described = []
+    for n, (i, key, image) in enumerate(pending):
+        if descriptions is None:
+            results[i] = await process_single_image(client, image_paths[i], image, prompt, limit)
+        else:
+            results[i] = {"status": "success", "description": descriptions[n]}
+        if results[i]["status"] == "success":
+            described.append((key, results[i]["description"]))
+    if described:
+        # The commit syncs to disk, so it runs on a reader thread rather than stalling the event loop
+        await asyncio.get_running_loop().run_in_executor(_readers, cache_descriptions, described)
+    return results
 
-    if not os.path.exists(OUTPUT_FILE):
-        open(OUTPUT_FILE, 'w', encoding='utf-8').close()
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
 
-    max_workers = min(10, os.cpu_count() or 1)
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_image = {
-            executor.submit(process_single_image, os.path.join(folder_path, image), prompt): image
-            for image in images_to_process
-        }
+def unhandled_results(chunk, e):
+    logging.error(f"Unhandled exception for batch {chunk}: {error_text(e)}\n{traceback.format_exc()}")
+    return [{"status": "error", "message": f"Unhandled exception: {error_text(e)}"}] * len(chunk)
+
+async def describe_images(folder_path, images_to_process, prompt, batch_size, output):
+    """
+    Runs on the shared event loop. Reader tasks load chunks on the reader threads and downscale them on
+    the encoder processes into a bounded queue, which backpressures them while up to MAX_INFLIGHT sender
+    tasks wait on Ollama.
+    """
+    loop = asyncio.get_running_loop()
+    chunks = list(batched(images_to_process, batch_size))
+    # Joined once; per image the path is then a plain concatenation
+    folder_prefix = os.path.join(folder_path, '')
+    unread = iter(chunks)
+    prepared = asyncio.Queue(maxsize=2 * MAX_INFLIGHT)
+    finished = asyncio.Queue()
+
+    async def encode_all(encoders, pending):
+        try:
+            futures = [loop.run_in_executor(encoders, encode_image, image_path) for _, _, image_path in pending]
+        except BrokenProcessPool as e:
+            return [e] * len(pending)
+        return await asyncio.gather(*futures, return_exceptions=True)
 
-        for count, future in enumerate(as_completed(future_to_image), start=1):
-            image = future_to_image[future]
+    async def encode_pending(image_paths, results, pending):
+        # A dead worker (e.g. OOM-killed on a huge image) breaks the whole pool: replace it and retry once
+        for attempt in range(2):
+            encoders = _encoders
+            images = await encode_all(encoders, pending)
+            if not any(isinstance(image, BrokenProcessPool) for image in images):
+                break
+            replace_encoders(encoders)
+        encoded = []
+        for (i, key, image_path), image in zip(pending, images):
+            if isinstance(image, (IOError, UnidentifiedImageError)):
+                logging.error(f"IOError processing image {image_path}: {str(image)}")
+                results[i] = {"status": "error", "message": f"IOError: {str(image)}"}
+            elif isinstance(image, BrokenProcessPool):
+                raise image
+            elif isinstance(image, Exception):
+                # Confined to this image so the rest of the chunk is still described
+                logging.error(f"Unexpected error encoding image {image_path}: {error_text(image)}")
+                results[i] = {"status": "error", "message": f"Unexpected error: {error_text(image)}"}
+            elif isinstance(image, BaseException):
+                raise image
+            else:
+                encoded.append((i, key, image))
+        return encoded
+
+    async def read_chunks():
+        for chunk in unread:
+            image_paths = [folder_prefix + image for image in chunk]
+            try:
+                results, pending = await loop.run_in_executor(_readers, read_batch, image_paths, prompt)
+                pending = await encode_pending(image_paths, results, pending)
+            except Exception as e:
+                await finished.put((chunk, unhandled_results(chunk, e)))
+                continue
+            await prepared.put((chunk, image_paths, results, pending))
+
+    async def send_chunks():
+        while True:
+            chunk, image_paths, results, pending = await prepared.get()
             try:
-                result = future.result()
+                results = await process_batch(_client, image_paths, prompt, results, pending)
+            except Exception as e:
+                results = unhandled_results(chunk, e)
+            await finished.put((chunk, results))
+
+    reader_tasks = [asyncio.create_task(read_chunks()) for _ in range(READER_THREADS)]
+    sender_tasks = [asyncio.create_task(send_chunks()) for _ in range(MAX_INFLIGHT)]
+    try:
+        count = 0
+        for _ in range(len(chunks)):
+            chunk, results = await finished.get()
+            for image, result in zip(chunk, results):
+                count += 1
                 if result["status"] == "success":
                     line = f"Processing image: {image}\nDescription: {result['description']}\n--------------"
-                    write_output(line)
-                    processed_images.add(image)
+                    write_output(output, line, image)
                 else:
                     error_message = f"Error processing image: {image}. Error: {result['message']}"
                     logging.error(error_message)
                     line = f"{error_message}\n--------------"
-                    write_output(line)
-            except Exception as e:
-                error_message = f"Unhandled exception for image {image}: {str(e)}"
-                logging.error(f"{error_message}\n{traceback.format_exc()}")
-                line = f"Unhandled exception for image: {image}. Error: {str(e)}\n--------------"
-                write_output(line)
-
+                    write_output(output, line)
+            # Published once per finished chunk rather than once per image
             progress['processed_images'] = count
-            if count % 100 == 0:
-                save_checkpoint(processed_images)
-                logging.info(f"Checkpoint saved at {count} images processed.")
+    finally:
+        for task in reader_tasks + sender_tasks:
+            task.cancel()
+        await asyncio.gather(*reader_tasks, *sender_tasks, return_exceptions=True)
+
+def process_images(folder_path, prompt):
+    global progress
+    configure_logging()
+    processed_images = load_checkpoint()
+    total_images = 0
+    images_to_process = []
+    # scandir reports file types from the directory listing, so no stat is needed per entry
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.name.lower().endswith(IMAGE_EXTENSIONS) or not entry.is_file():
+                continue
+            total_images += 1
+            if entry.name not in processed_images:
+                images_to_process.append(entry.name)
+    remaining = len(images_to_process)
+
+    if remaining == 0:
+        flash("All images have already been processed.", "info")
+        return
+
+    progress['total_images'] = total_images
+    progress['processed_images'] = 0
+    # Monotonic so a clock adjustment mid-run can't skew the elapsed time
+    progress['start_time'] = time.monotonic()
+    progress['running'] = True
+
+    # Shrink batches when there are too few images to keep every request slot busy
+    batch_size = max(1, min(BATCH_SIZE if _batching_supported else 1, -(-remaining // MAX_INFLIGHT)))
+    checkpoint = open_checkpoint()
+    output, writer = start_output_writer(checkpoint)
+    try:
+        run = describe_images(folder_path, images_to_process, prompt, batch_size, output)
+        asyncio.run_coroutine_threadsafe(run, start_runtime()).result()
+    finally:
+        stop_output_writer(output, writer)
+        checkpoint.close()
+        progress['running'] = False
 
-    save_checkpoint(processed_images)
     cleanup_files()
     flash("Image descriptions have been generated and saved to Output_Descriptions.txt", "success")
 
@@ -166,21 +590,46 @@ def download():
         flash(f"Error downloading file: {str(e)}", "error")
         return redirect(url_for('index'))
 
-@app.route('/progress')
-def get_progress():
-    global progress
+def progress_snapshot():
     if progress['start_time'] is not None:
-        elapsed_time = time.time() - progress['start_time']
+        elapsed_time = time.monotonic() - progress['start_time']
     else:
         elapsed_time = 0
-    return jsonify({
+    return {
         'total_images': progress['total_images'],
         'processed_images': progress['processed_images'],
+        'running': progress['running'],
         'elapsed_time': elapsed_time
-    })
+    }
+
+@app.route('/progress')
+def get_progress():
+    return jsonify(progress_snapshot())
+
+@app.route('/events')
+def progress_events():
+    """Server-sent events pushing a progress snapshot whenever the processed count changes"""
+    def generate():
+        last_state = None
+        last_sent = time.monotonic()
+        while True:
+            snapshot = progress_snapshot()
+            state = (snapshot['total_images'], snapshot['processed_images'], snapshot['running'])
+            if state != last_state:
+                yield f"data: {json.dumps(snapshot)}\n\n"
+                last_state = state
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent > EVENT_KEEPALIVE:
+                # Comment line; lets the server notice a closed connection while the count is idle
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
+            time.sleep(EVENT_INTERVAL)
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 # Ensure the app runs only when executed directly
 if __name__ == '__main__':
+    configure_logging()
     app.run(
         debug=True,
         host='0.0.0.0',